@@ -1,6 +1,10 @@
 from . import epub2 as _
 from . import epub3 as _
+from .cache import BuildCache
 from .open import open
+from .transform import index
+from .transform import optimize
+from .transform import split
 from .epub import AttributedString
 
 
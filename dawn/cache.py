@@ -0,0 +1,32 @@
+import json
+import os
+
+
+class BuildCache(dict):
+	"""
+	Maps output paths to the digest of what was last written there, so that
+	dawn.open(path, mode='w', cache=cache) can skip rewriting unchanged books.
+	Paths written during this session are listed in updated.
+	"""
+
+	def __init__(self, path=None):
+		super().__init__()
+		self.path = path
+		self.updated = set()
+		if path is not None and os.path.exists(path):
+			with open(path, 'r') as f:
+				self.update(json.load(f))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.save()
+
+	def save(self):
+		if self.path is None:
+			return
+		tmp = '{}.tmp'.format(self.path)
+		with open(tmp, 'w') as f:
+			json.dump(self, f, indent='\t', sort_keys=True)
+		os.replace(tmp, self.path)
@@ -0,0 +1,193 @@
+import argparse
+import json
+import multiprocessing
+import os
+import posixpath
+import sys
+
+from .epub import AttributedString
+from .open import open as dawn_open
+
+
+def _astr(astr):
+	if astr is None:
+		return None
+	return dict(astr, value=astr.value)
+
+def _meta(epub):
+	res = {}
+	for k, v in epub.meta.items():
+		if k == 'dates':
+			res[k] = {d: dt and dt.isoformat() for d, dt in v.items()}
+		elif isinstance(v, list):
+			res[k] = [_astr(a) if isinstance(a, AttributedString) else a for a in v]
+		else:
+			res[k] = _astr(v) if isinstance(v, AttributedString) else v
+	return res
+
+def _toc(items):
+	res = []
+	for it in items:
+		d = {'href': it.href, 'title': it.title}
+		if it.children:
+			d['children'] = _toc(it.children)
+		res.append(d)
+	return res
+
+
+def info(epub, options):
+	return {
+		'version': epub.version,
+		'uid': _astr(epub.uid),
+		'meta': _meta(epub),
+		'manifest': len(epub.manifest),
+		'spine': len(epub.spine),
+	}
+
+def toc(epub, options):
+	return {'title': epub.toc.title, 'toc': _toc(epub.toc)}
+
+def ls(epub, options):
+	spine = {item.iid for item in epub.spine}
+	return {'manifest': [
+		{'id': item.iid, 'href': item.href, 'mimetype': item.mimetype, 'spine': item.iid in spine}
+		for item in epub.manifest.values()
+	]}
+
+def extract(epub, options):
+	dest = os.path.join(options.output, os.path.splitext(os.path.basename(options.path))[0])
+	files = 0
+	for item, f in epub.iterfiles():
+		href = posixpath.normpath(item.href)
+		if href.startswith('../') or posixpath.isabs(href):
+			raise ValueError('Refusing to extract {} outside of {}'.format(item.href, dest))
+		path = os.path.join(dest, *href.split('/'))
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, 'wb') as out:
+			while True:
+				data = f.read(64 * 1024)
+				if not data:
+					break
+				out.write(data)
+		files += 1
+	return {'output': dest, 'files': files}
+
+def validate(epub, options):
+	errors = []
+	names = set(epub._zf.namelist())
+	opfdir = posixpath.dirname(epub._opfpath)
+
+	first = epub._zf.infolist()[0]
+	if first.filename != 'mimetype' or first.compress_type != 0:
+		errors.append('mimetype should be the first entry and stored uncompressed')
+
+	items = list(epub.manifest.values())
+	if epub.toc.item is not None:
+		items.append(epub.toc.item)
+	for item in items:
+		if posixpath.join(opfdir, item.href) not in names:
+			errors.append('Missing manifest item {} ({})'.format(item.iid, item.href))
+
+	def check_toc(toc):
+		for it in toc:
+			try:
+				epub.manifest.byhref(it.href)
+			except KeyError:
+				errors.append('TOC entry {!r} points outside the manifest ({})'.format(it.title, it.href))
+			check_toc(it.children)
+	check_toc(epub.toc)
+
+	if not epub.spine:
+		errors.append('Empty spine')
+	if not epub.meta['titles']:
+		errors.append('Missing title')
+	if not epub.uid:
+		errors.append('Missing unique identifier')
+
+	return {'valid': not errors, 'errors': errors}
+
+
+def stats(epub, options):
+	return {'items': [dict(item._asdict(), ratio=item.ratio) for item in epub.stats()]}
+
+
+COMMANDS = {
+	'info': info,
+	'toc': toc,
+	'ls': ls,
+	'extract': extract,
+	'validate': validate,
+	'stats': stats,
+}
+
+
+def _run(task):
+	command, options = task
+	res = {'path': options.path}
+	try:
+		with dawn_open(options.path) as epub:
+			res.update(COMMANDS[command](epub, options))
+	except Exception as e:
+		if command == 'validate':
+			res.update(valid=False, errors=['{}: {}'.format(type(e).__name__, e)])
+		else:
+			res['error'] = '{}: {}'.format(type(e).__name__, e)
+	return res
+
+def _paths(options):
+	yield from options.paths
+	for fname in options.files_from or []:
+		f = sys.stdin if fname == '-' else open(fname, 'r')
+		with f:
+			for line in f:
+				line = line.strip()
+				if line:
+					yield line
+
+def _tasks(command, options):
+	for path in _paths(options):
+		opts = argparse.Namespace(**vars(options))
+		opts.path = path
+		yield command, opts
+
+
+def parser():
+	p = argparse.ArgumentParser(prog='dawn', description='Inspect ePubs, outputs JSON lines')
+	sub = p.add_subparsers(dest='command', metavar='command')
+	sub.required = True
+
+	for name in COMMANDS:
+		s = sub.add_parser(name)
+		s.add_argument('paths', nargs='*', metavar='path')
+		s.add_argument('-f', '--files-from', action='append', metavar='FILE', help='read paths from FILE (- for stdin)')
+		s.add_argument('-j', '--jobs', type=int, default=1, help='number of worker processes')
+		if name == 'extract':
+			s.add_argument('-o', '--output', default='.', help='output directory')
+
+	return p
+
+def main(argv=None):
+	options = parser().parse_args(argv)
+	command = options.command
+	tasks = _tasks(command, options)
+
+	failed = False
+	def emit(res):
+		nonlocal failed
+		failed = failed or 'error' in res or res.get('valid') is False
+		sys.stdout.write(json.dumps(res, sort_keys=True) + '\n')
+		sys.stdout.flush()
+
+	if options.jobs > 1:
+		with multiprocessing.Pool(options.jobs) as pool:
+			for res in pool.imap_unordered(_run, tasks, chunksize=4):
+				emit(res)
+	else:
+		for task in tasks:
+			emit(_run(task))
+
+	return 1 if failed else 0
+
+
+if __name__ == '__main__': # pragma: no cover
+	sys.exit(main())
@@ -1,12 +1,19 @@
 import abc
 import collections
 import datetime
+import hashlib
+import heapq
+import itertools
 import lxml.etree
 import mimetypes
 import posixpath
+import tempfile
 import uuid
 import zipfile
 
+from . import positions
+from . import search
+from .stream import SPOOL_SIZE
 from .utils import E
 from .utils import getxmlattr
 from .utils import NS
@@ -14,6 +21,10 @@ from .utils import NS
 
 VERSIONS = {}
 
+# Used for the dates and the zip timestamps in deterministic mode
+EPOCH = datetime.datetime(1980, 1, 1)
+_UID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'https://github.com/Glose/dawn')
+
 class Epub(abc.ABC):
 	version = None
 
@@ -24,6 +35,14 @@ class Epub(abc.ABC):
 	def __init__(self, zf, opfpath):
 		self._opfpath = opfpath
 		self._zf = zf
+		self._deferred = None
+		self._deterministic = False
+		self._hash = None
+		self._ids = itertools.count()
+		self._index = None
+		self._search = None
+		self._measures = None
+		self._positions = None
 
 		self.manifest = Manifest()
 		self.spine = Spine()
@@ -50,8 +69,19 @@ class Epub(abc.ABC):
 		uid_id = opftree.get('unique-identifier')
 		self.uid = next(filter(lambda i: i.get('id') == uid_id, self.meta['identifiers']), None)
 
-	def _init_write(self):
-		self.uid = AttributedString(uuid.uuid4())
+	def _init_write(self, reader_layout=False, deterministic=False, search_index=False, positions=False):
+		if reader_layout:
+			self._deferred = _Deferred()
+		if search_index:
+			self._index = search.IndexBuilder()
+		if positions:
+			self._measures = {}
+		if deterministic:
+			self._deterministic = True
+			self._hash = hashlib.sha1()
+
+		# in deterministic mode, the uid is derived from the book on close
+		self.uid = AttributedString('' if deterministic else str(uuid.uuid4()))
 		self.uid['id'] = 'uid_id'
 		self.uid['scheme'] = 'uuid'
 		self.meta['identifiers'] = [self.uid]
@@ -73,11 +103,31 @@ class Epub(abc.ABC):
 		)
 
 	def _write_opf(self):
-		self.meta['dates']['modification'] = datetime.datetime.now()
-
+		if not self._deterministic:
+			self.meta['dates']['modification'] = datetime.datetime.now()
+		elif self.meta['dates']['modification'] is None:
+			self.meta['dates']['modification'] = EPOCH
+		if self._deterministic and not self.uid:
+			# the content written so far tells apart the books sharing metadata
+			meta = sorted((k, repr(v)) for k, v in self.meta.items() if k not in ('identifiers', 'dates'))
+			ids = [repr(i) for i in self.meta['identifiers'] if i is not self.uid]
+			self.uid.value = str(uuid.uuid5(_UID_NAMESPACE, repr((meta, ids, self._hash.hexdigest()))))
+
+		# the nav document may be in the spine, and is indexed and measured
 		if self.toc:
 			self._write_toc()
 
+		if self._index is not None:
+			data = self._index.build([item.href for item in self.spine])
+			item = self.manifest.Item(search.INDEX_ID, search.INDEX_HREF)
+			self.writestr(item, data, compress_type=zipfile.ZIP_STORED)
+
+		if self._measures is not None:
+			empty = positions.Measure(b'<html/>')
+			pmap = self._position_map([self._measures.get(item.href, empty) for item in self.spine])
+			item = self.manifest.Item(positions.POSITIONS_ID, positions.POSITIONS_HREF)
+			self.writestr(item, pmap.tobytes())
+
 		pkg = E['opf'].package(
 			{'version': self.version, 'unique-identifier': self.uid['id']},
 			self._xml_meta(),
@@ -86,6 +136,26 @@ class Epub(abc.ABC):
 		)
 		self._writestr(self._opfpath, lxml.etree.tostring(pkg, pretty_print=True))
 
+		if self._deferred is not None:
+			self._write_deferred()
+
+	def _write_deferred(self):
+		# mimetype, container, OPF and TOC first, then the spine in reading
+		# order, so that readers can render the first pages from a prefix
+		first = ['mimetype', 'META-INF/container.xml', self._opfpath]
+		if self.toc.item is not None:
+			first.append(self.__opfpath(self.toc.item.href))
+		first.extend(self.__opfpath(item.href) for item in self.spine)
+
+		# the spine may reference the same item twice
+		first = collections.OrderedDict.fromkeys(first)
+
+		deferred, self._deferred = self._deferred, None
+		with deferred:
+			for name in [n for n in first if n in deferred] + [n for n in deferred if n not in first]:
+				data, kwargs = deferred.take(name)
+				self._zipwrite(name, data, **kwargs)
+
 	@abc.abstractmethod
 	def _read_toc(self, opftree): # pragma: no cover
 		...
@@ -128,14 +198,46 @@ class Epub(abc.ABC):
 	def write(self, *args, **kwargs):
 		raise NotImplementedError('Use writestr')
 
-	def _writestr(self, *args, **kwargs):
-		self._zf.writestr(*args, **kwargs)
+	def _writestr(self, name, data, **kwargs):
+		if isinstance(data, str):
+			data = data.encode('utf-8')
+		if self._hash is not None:
+			self._hash.update(repr((name, sorted(kwargs.items()), len(data))).encode('utf-8'))
+			self._hash.update(data)
+
+		if self._deferred is not None:
+			self._deferred.add(name, data, kwargs)
+		else:
+			self._zipwrite(name, data, **kwargs)
+
+	def _zipwrite(self, name, data, **kwargs):
+		if self._deterministic:
+			zinfo = zipfile.ZipInfo(name, date_time=EPOCH.timetuple()[:6])
+			zinfo.compress_type = self._zf.compression
+			zinfo.external_attr = 0o600 << 16
+			# Unix, whatever the host (ZipInfo defaults to 0 on Windows)
+			zinfo.create_system = 3
+			if getattr(self._zf, 'compresslevel', None) is not None:
+				kwargs.setdefault('compresslevel', self._zf.compresslevel)
+			name = zinfo
+		self._zf.writestr(name, data, **kwargs)
+
+	def _new_id(self):
+		if self._deterministic:
+			return 'id-{}'.format(next(self._ids))
+		return str(uuid.uuid4())
 
 	def writestr(self, item, data, iid=None, **kwargs):
 		if isinstance(item, zipfile.ZipInfo):
 			raise NotImplementedError('item should be a path relative to the opfdir or an Item')
 		if not isinstance(item, self.manifest.Item) or item.iid not in self.manifest:
 			item = self.manifest.add(item)
+		if isinstance(data, str):
+			data = data.encode('utf-8')
+		if self._index is not None and item.mimetype == 'application/xhtml+xml':
+			self._index.add(item.href, data)
+		if self._measures is not None and item.mimetype == 'application/xhtml+xml':
+			self._measures[item.href] = positions.Measure(data)
 
 		self._writestr(self.__opfpath(item.href), data, **kwargs)
 		return item
@@ -145,6 +247,72 @@ class Epub(abc.ABC):
 			item = item.href
 		return self._zf.open(self.__opfpath(item), *args, **kwargs)
 
+	def iterfiles(self):
+		items = {self.__opfpath(item.href): item for item in self.manifest.values()}
+
+		if isinstance(self._zf, zipfile.ZipFile):
+			entries = ((zinfo, self._zf.open(zinfo)) for zinfo in self._zf.infolist())
+		else:
+			entries = self._zf.iterfiles()
+
+		for zinfo, f in entries:
+			with f:
+				item = items.get(zinfo.filename)
+				if item is not None:
+					yield item, f
+
+	def search(self, term):
+		words = [w for w, o in search.tokenize(term)]
+		if len(words) != 1:
+			raise ValueError('Can only search for a single word')
+		if self._search is None:
+			item = self.manifest.byhref(search.INDEX_HREF)
+			self._search = search.SearchIndex.load(self._zf, self.__opfpath(item.href))
+		return [(self.spine[i], offset) for i, offset in self._search.lookup(words[0])]
+
+	def positions(self):
+		if self._positions is None:
+			try:
+				item = self.manifest.byhref(positions.POSITIONS_HREF)
+			except KeyError:
+				measures = []
+				for item in self.spine:
+					with self.open(item) as f:
+						measures.append(positions.Measure(f.read()))
+				self._positions = self._position_map(measures)
+			else:
+				with self.open(item) as f:
+					self._positions = positions.PositionMap.frombytes(f.read())
+		return self._positions
+
+	def _position_map(self, measures):
+		spine = {}
+		for i, item in enumerate(self.spine):
+			spine.setdefault(item.href, i)
+		toc = []
+		for it in positions.flatten_toc(self.toc):
+			href, _, fragment = it.href.partition('#')
+			toc.append((spine.get(href), fragment))
+		return positions.PositionMap.build(measures, toc)
+
+	def stats(self):
+		items = list(self.manifest.values())
+		if self.toc.item is not None:
+			items.append(self.toc.item)
+		spine = {item.iid: i for i, item in enumerate(self.spine)}
+
+		res = Stats()
+		for item in items:
+			try:
+				zinfo = self._zf.getinfo(self.__opfpath(item.href))
+			except KeyError:
+				continue
+			res.append(res.Item(
+				item.iid, item.href, item.mimetype, spine.get(item.iid),
+				zinfo.file_size, zinfo.compress_size, zinfo.compress_type,
+			))
+		return res
+
 	def __opfpath(self, path):
 		return posixpath.join(posixpath.dirname(self._opfpath), path)
 
@@ -152,6 +320,30 @@ class Epub(abc.ABC):
 		return '<Epub {} (len(manifest): {}, len(spine): {})>'.format(self.version, len(self.manifest), len(self.spine))
 
 
+class _Deferred(collections.OrderedDict):
+	# Entries waiting to be written, with their data spooled to a single
+	# temporary file that only stays in memory up to SPOOL_SIZE
+	def __init__(self):
+		super().__init__()
+		self._spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self._spool.close()
+
+	def add(self, name, data, kwargs):
+		self._spool.seek(0, 2)
+		self[name] = (self._spool.tell(), len(data), kwargs)
+		self._spool.write(data)
+
+	def take(self, name):
+		offset, size, kwargs = self.pop(name)
+		self._spool.seek(offset)
+		return self._spool.read(size), kwargs
+
+
 class Manifest(dict):
 	class Item:
 		def __init__(self, iid, href):
@@ -225,6 +417,34 @@ class Toc(TocItems):
 		super().__init__()
 
 
+class Stats(list):
+	class Item(collections.namedtuple('Item', (
+		'iid', 'href', 'mimetype', 'spine', 'file_size', 'compress_size', 'compress_type',
+	))):
+		__slots__ = ()
+
+		@property
+		def ratio(self):
+			return self.compress_size / self.file_size if self.file_size else 1.
+
+	def bymimetype(self):
+		res = {}
+		for item in self:
+			count, file_size, compress_size = res.get(item.mimetype, (0, 0, 0))
+			res[item.mimetype] = (count + 1, file_size + item.file_size, compress_size + item.compress_size)
+		return res
+
+	def largest(self, n=10, spine=True):
+		items = (item for item in self if not spine or item.spine is not None)
+		return heapq.nlargest(n, items, key=lambda item: item.file_size)
+
+	def poorly_compressed(self, ratio=.9, min_size=1024):
+		return [
+			item for item in self
+			if item.file_size >= min_size and item.ratio >= ratio
+		]
+
+
 class AttributedString(collections.UserDict):
 	def __init__(self, value, **kwargs):
 		self.value = value
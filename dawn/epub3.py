@@ -1,5 +1,4 @@
 import lxml.etree
-import uuid
 
 from .epub import AttributedString
 from .epub import Epub
@@ -121,7 +120,7 @@ class Epub30(Epub):
 						m.attrib[ns(k)] = val
 				meta.append(m)
 				if attrs_to_add:
-					m.attrib['id'] = str(uuid.uuid4())
+					m.attrib['id'] = self._new_id()
 					for k in attrs_to_add:
 						meta.append(E['opf'].meta(str(astr[k]), {
 							'refines': '#{}'.format(m.attrib['id']),
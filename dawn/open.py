@@ -1,23 +1,54 @@
+import io
 import lxml.etree
+import os
+import shutil
+import tempfile
 import zipfile
 
 from .epub import VERSIONS
+from .stream import SPOOL_SIZE
+from .stream import StreamZipFile
 from .utils import NS
 
 
 class open:
-	def __init__(self, infile, mode='r', version=None, opfpath=None):
+	def __init__(self, infile, mode='r', version=None, opfpath=None, stream=False, reader_layout=False,
+			compression=zipfile.ZIP_STORED, compresslevel=None, deterministic=False, cache=None,
+			search_index=False, positions=False):
 		if mode not in ('r', 'w'):
 			raise TypeError('Supported modes are r, w and a')
 		if mode == 'r' and opfpath is not None:
 			raise TypeError('opfpath should only be used in w mode')
 		if mode == 'w' and version is None:
 			raise TypeError('version is required in w mode')
+		if mode == 'w' and stream:
+			raise TypeError('stream should only be used in r mode')
+		if mode == 'r' and reader_layout:
+			raise TypeError('reader_layout should only be used in w mode')
+		if mode == 'r' and (deterministic or cache is not None or search_index or positions):
+			raise TypeError('deterministic, cache, search_index and positions should only be used in w mode')
+		if cache is not None and not isinstance(infile, (str, os.PathLike)):
+			raise TypeError('cache requires a path')
 
 		self._mode = mode
 		self._opfpath = opfpath
 		self._version = version
-		self._zf = zipfile.ZipFile(infile, mode=mode)
+		self._reader_layout = reader_layout
+		self._deterministic = deterministic or cache is not None
+		self._cache = cache
+		self._search_index = search_index
+		self._positions = positions
+		self._path = infile
+
+		if cache is not None:
+			# written to a temporary file, only copied to infile if it changed
+			infile = self._tmp = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+		if stream:
+			self._zf = StreamZipFile(infile)
+		else:
+			kwargs = {} if compresslevel is None else {'compresslevel': compresslevel}
+			self._zf = zipfile.ZipFile(infile, mode=mode, compression=compression, **kwargs)
 
 	def __enter__(self):
 		self._zf.__enter__()
@@ -40,7 +71,12 @@ class open:
 			assert self._mode == 'w'
 			opfpath = self._opfpath or 'content.opf'
 			self._epub = VERSIONS[self._version](self._zf, opfpath)
-			self._epub._init_write()
+			self._epub._init_write(
+				reader_layout=self._reader_layout,
+				deterministic=self._deterministic,
+				search_index=self._search_index,
+				positions=self._positions,
+			)
 
 		return self._epub
 
@@ -48,5 +84,22 @@ class open:
 		if self._mode == 'w':
 			self._epub._write_opf()
 		self._zf.__exit__(*args)
+		if self._cache is not None:
+			with self._tmp:
+				if args[0] is None:
+					self._update(self._epub._hash.hexdigest())
 		del self._epub
 		del self._zf
+
+	def _update(self, digest):
+		path = os.fspath(self._path)
+		if self._cache.get(path) == digest and os.path.exists(path):
+			return
+
+		self._tmp.seek(0)
+		tmp = '{}.tmp'.format(path)
+		with io.open(tmp, 'wb') as f:
+			shutil.copyfileobj(self._tmp, f)
+		os.replace(tmp, path)
+		self._cache[path] = digest
+		self._cache.updated.add(path)
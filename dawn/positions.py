@@ -0,0 +1,220 @@
+import bisect
+import itertools
+import lxml.etree
+import struct
+import sys
+import xml.parsers.expat
+
+from .search import walk_document
+from .utils import BLOCKS
+from .utils import uint32_view
+from .utils import uint32s
+
+
+POSITIONS_ID = 'positions'
+POSITIONS_HREF = 'positions.bin'
+
+_MAGIC = b'DWNPOS01'
+_HEADER = struct.Struct('<8sLLL')
+_NONE = 0xFFFFFFFF
+
+
+class Measure:
+	"""
+	Length in characters (see search.document_text) and bytes of a spine
+	document, with the character and byte offsets of its block elements and
+	the character offsets of its ids. Byte offsets are those of the start
+	tags, 0 when the document is not well-formed XML.
+	"""
+
+	def __init__(self, data):
+		text, elements = walk_document(data)
+		self.chars = len(text)
+		self.size = len(data)
+		self.blocks = uint32s()
+		self.block_bytes = uint32s()
+		self.ids = {}
+
+		body = elements[0][0] if elements else None
+		tags = _start_tags(data)
+		order = {}
+		if body is not None and tags is not None:
+			order = {el: i for i, el in enumerate(body.getroottree().getroot().iter(lxml.etree.Element))}
+			if len(order) != len(tags):
+				order = {}
+
+		for el, offset in elements:
+			block = el is not body and lxml.etree.QName(el).localname in BLOCKS
+			if block and (not self.blocks or self.blocks[-1] != offset):
+				self.blocks.append(offset)
+				self.block_bytes.append(tags[order[el]] if el in order else 0)
+			if el.get('id') is not None:
+				self.ids.setdefault(el.get('id'), offset)
+
+
+class PositionMap:
+	"""
+	Cumulative character and byte offsets of the spine items and of their
+	block elements, and character offsets of the TOC entries (flattened in
+	document order, None when they point outside the spine).
+
+	Per item values are stored, the cumulative ones are computed on load so
+	that replacing an item with update() only measures that item.
+	"""
+
+	def __init__(self, chars, sizes, counts, blocks, block_bytes, toc_items, toc_offsets, fragments):
+		self._chars = chars
+		self._sizes = sizes
+		self._counts = counts
+		self._blocks = blocks
+		self._block_bytes = block_bytes
+		self._toc_items = toc_items
+		self._toc_offsets = toc_offsets
+		self._fragments = fragments
+		self._cumulate()
+
+	@classmethod
+	def build(cls, measures, toc):
+		# measures are the Measure of each spine item, toc (spine index,
+		# fragment) pairs with None as index for entries outside the spine
+		res = cls(uint32s(), uint32s(), uint32s(), uint32s(), uint32s(), uint32s(), uint32s(), [])
+		for m in measures:
+			res._chars.append(m.chars)
+			res._sizes.append(m.size)
+			res._counts.append(len(m.blocks))
+			res._blocks.extend(m.blocks)
+			res._block_bytes.extend(m.block_bytes)
+		for idx, fragment in toc:
+			res._toc_items.append(_NONE if idx is None else idx)
+			res._toc_offsets.append(0 if idx is None else _resolve(measures[idx], fragment))
+			res._fragments.append(fragment or '')
+		res._cumulate()
+		return res
+
+	def _cumulate(self):
+		self._starts = uint32s(itertools.accumulate(itertools.chain([0], self._chars)))
+		self._size_starts = uint32s(itertools.accumulate(itertools.chain([0], self._sizes)))
+		self._block_starts = uint32s(itertools.accumulate(itertools.chain([0], self._counts)))
+
+	def __len__(self):
+		return len(self._chars)
+
+	@property
+	def length(self):
+		return self._starts[-1]
+
+	@property
+	def size(self):
+		return self._size_starts[-1]
+
+	def start(self, i):
+		return self._starts[i]
+
+	def byte_start(self, i):
+		return self._size_starts[i]
+
+	def locate(self, offset):
+		"""(spine index, offset in the item) of a character offset in the book"""
+		if not len(self):
+			raise IndexError('Empty position map')
+		offset = min(max(offset, 0), max(self.length - 1, 0))
+		i = bisect.bisect_right(self._starts, offset, 0, len(self)) - 1
+		return i, offset - self._starts[i]
+
+	def locate_fraction(self, fraction):
+		return self.locate(int(fraction * self.length))
+
+	def blocks(self, i):
+		start = self._starts[i]
+		return [start + o for o in self._blocks[self._block_starts[i]:self._block_starts[i + 1]]]
+
+	def byte_blocks(self, i):
+		start = self._size_starts[i]
+		return [start + o for o in self._block_bytes[self._block_starts[i]:self._block_starts[i + 1]]]
+
+	def block_start(self, offset):
+		"""Character offset of the start of the block containing offset"""
+		i, local = self.locate(offset)
+		blocks = self._blocks[self._block_starts[i]:self._block_starts[i + 1]]
+		j = bisect.bisect_right(blocks, local) - 1
+		return self._starts[i] + (blocks[j] if j >= 0 else 0)
+
+	@property
+	def toc(self):
+		return [
+			None if idx == _NONE else self._starts[idx] + offset
+			for idx, offset in zip(self._toc_items, self._toc_offsets)
+		]
+
+	def update(self, i, data):
+		"""Replace the measures of the spine item i with those of data"""
+		m = Measure(data)
+		self._chars[i] = m.chars
+		self._sizes[i] = m.size
+		a, b = self._block_starts[i], self._block_starts[i + 1]
+		self._blocks[a:b] = m.blocks
+		self._block_bytes[a:b] = m.block_bytes
+		self._counts[i] = len(m.blocks)
+		for j, idx in enumerate(self._toc_items):
+			if idx == i:
+				self._toc_offsets[j] = _resolve(m, self._fragments[j])
+		self._cumulate()
+
+	def tobytes(self):
+		fragments = [f.encode('utf-8') for f in self._fragments]
+		fragment_offsets = uint32s(itertools.accumulate(itertools.chain([0], map(len, fragments))))
+		arrays = [
+			self._chars, self._sizes, self._counts, self._blocks, self._block_bytes,
+			self._toc_items, self._toc_offsets, fragment_offsets,
+		]
+		data = []
+		for a in arrays:
+			if sys.byteorder != 'little':
+				a = uint32s(a)
+				a.byteswap()
+			data.append(a.tobytes())
+		header = _HEADER.pack(_MAGIC, len(self._chars), len(self._blocks), len(self._toc_items))
+		return b''.join([header] + data + fragments)
+
+	@classmethod
+	def frombytes(cls, buf):
+		buf = memoryview(buf)
+		magic, n, nblocks, ntoc = _HEADER.unpack(buf[:_HEADER.size])
+		if magic != _MAGIC:
+			raise ValueError('Not a dawn position map')
+
+		pos = _HEADER.size
+		arrays = []
+		for count in (n, n, n, nblocks, nblocks, ntoc, ntoc, ntoc + 1):
+			arrays.append(uint32s(uint32_view(buf[pos:pos + 4 * count])))
+			pos += 4 * count
+		fragment_offsets = arrays.pop()
+		blob = buf[pos:].tobytes()
+		fragments = [
+			blob[a:b].decode('utf-8')
+			for a, b in zip(fragment_offsets, fragment_offsets[1:])
+		]
+		return cls(*arrays, fragments)
+
+
+def _start_tags(data):
+	# Byte offsets of the start tags in document order (which lxml does not
+	# give), None if expat cannot parse data
+	res = []
+	parser = xml.parsers.expat.ParserCreate()
+	parser.StartElementHandler = lambda name, attrs: res.append(parser.CurrentByteIndex)
+	try:
+		parser.Parse(data, True)
+	except xml.parsers.expat.ExpatError:
+		return None
+	return res
+
+def _resolve(measure, fragment):
+	if not fragment:
+		return 0
+	return measure.ids.get(fragment, 0)
+
+def flatten_toc(toc):
+	for item in toc:
+		yield item
+		yield from flatten_toc(item.children)
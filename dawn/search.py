@@ -0,0 +1,198 @@
+import bisect
+import collections
+import html
+import lxml.etree
+import lxml.html
+import mmap
+import os
+import re
+import struct
+import sys
+import zipfile
+
+from .utils import BLOCKS
+from .utils import uint32_view
+from .utils import uint32s
+
+
+INDEX_ID = 'search-index'
+INDEX_HREF = 'search-index.bin'
+
+_MAGIC = b'DWNIDX01'
+_HEADER = struct.Struct('<8sLL')
+_WORDS = re.compile(r'\w+')
+_SKIP = {'script', 'style', 'head'}
+# Elements separating words even without whitespace around them
+_BREAKS = BLOCKS | {'br'}
+
+
+def document_text(data):
+	"""
+	Text content of the body of an (X)HTML document, as used for the offsets
+	of the search index: the text nodes in document order, without script
+	and style elements, with a newline between blocks.
+	"""
+	return walk_document(data)[0]
+
+def walk_document(data):
+	"""
+	Same as document_text, also returning the (element, offset) of every
+	element of the body, offset being where its text starts.
+	"""
+	if isinstance(data, str):
+		# lxml rejects str with an encoding declaration
+		data = data.encode('utf-8')
+	try:
+		root = lxml.etree.fromstring(data, lxml.etree.XMLParser(huge_tree=True, resolve_entities=False))
+	except (lxml.etree.XMLSyntaxError, ValueError):
+		try:
+			root = lxml.html.fromstring(data)
+		except lxml.etree.ParserError:
+			# empty document
+			return '', []
+
+	body = next(root.iter('{*}body', 'body'), root)
+	parts = []
+	elements = []
+	length = 0
+
+	def add(text):
+		nonlocal length
+		parts.append(text)
+		length += len(text)
+
+	def boundary():
+		if parts and not parts[-1].endswith('\n'):
+			add('\n')
+
+	def walk(el):
+		breaks = el is not body and lxml.etree.QName(el).localname in _BREAKS
+		if breaks:
+			boundary()
+		elements.append((el, length))
+		if el.text:
+			add(el.text)
+		for c in el:
+			if isinstance(c, lxml.etree._Entity):
+				# not resolved, see the parser above
+				add(html.unescape(c.text))
+			elif isinstance(c.tag, str) and lxml.etree.QName(c).localname not in _SKIP:
+				walk(c)
+			if c.tail:
+				add(c.tail)
+		if breaks:
+			boundary()
+	walk(body)
+
+	return ''.join(parts), elements
+
+def tokenize(text):
+	for m in _WORDS.finditer(text):
+		yield m.group().casefold(), m.start()
+
+
+class IndexBuilder:
+	def __init__(self):
+		self._docs = {}
+
+	def add(self, href, data):
+		postings = collections.defaultdict(uint32s)
+		for word, offset in tokenize(document_text(data)):
+			postings[word].append(offset)
+		self._docs[href] = postings
+
+	def build(self, hrefs):
+		# hrefs are the spine items, postings point to their index in it
+		terms = collections.defaultdict(list)
+		for i, href in enumerate(hrefs):
+			for word, offsets in self._docs.get(href, {}).items():
+				terms[word.encode('utf-8')].append((i, offsets))
+
+		blob = bytearray()
+		term_offsets = uint32s([0])
+		posting_offsets = uint32s([0])
+		docs = uint32s()
+		offsets = uint32s()
+		for term in sorted(terms):
+			blob += term
+			term_offsets.append(len(blob))
+			for i, o in terms[term]:
+				docs.extend([i] * len(o))
+				offsets.extend(o)
+			posting_offsets.append(len(docs))
+
+		arrays = [term_offsets, posting_offsets, docs, offsets]
+		if sys.byteorder != 'little':
+			for a in arrays:
+				a.byteswap()
+		return b''.join([_HEADER.pack(_MAGIC, len(terms), len(docs))] + [a.tobytes() for a in arrays] + [bytes(blob)])
+
+
+class SearchIndex:
+	"""
+	Read side of the index: a sorted array of terms, binary searched, each
+	pointing to a slice of the (spine index, character offset) postings.
+	"""
+
+	def __init__(self, buf):
+		buf = memoryview(buf)
+		magic, nterms, npostings = _HEADER.unpack(buf[:_HEADER.size])
+		if magic != _MAGIC:
+			raise ValueError('Not a dawn search index')
+
+		pos = _HEADER.size
+		sections = []
+		for n in (nterms + 1, nterms + 1, npostings, npostings):
+			sections.append(uint32_view(buf[pos:pos + 4 * n]))
+			pos += 4 * n
+		self._terms, self._postings, self._docs, self._offsets = sections
+		self._blob = buf[pos:]
+		self._nterms = nterms
+
+	def __len__(self):
+		return self._nterms
+
+	def _term(self, i):
+		return self._blob[self._terms[i]:self._terms[i + 1]].tobytes()
+
+	def lookup(self, word):
+		word = word.encode('utf-8')
+		i = bisect.bisect_left(_Keys(self), word)
+		if i == self._nterms or self._term(i) != word:
+			return []
+		a, b = self._postings[i], self._postings[i + 1]
+		return list(zip(self._docs[a:b], self._offsets[a:b]))
+
+	@classmethod
+	def load(cls, zf, name):
+		zinfo = zf.getinfo(name)
+		fileno = _fileno(zf)
+		if zinfo.compress_type != zipfile.ZIP_STORED or fileno is None or not hasattr(os, 'pread'):
+			with zf.open(zinfo) as f:
+				return cls(f.read())
+
+		# stored in a real file, map it instead of reading it
+		header = os.pread(fileno, 30, zinfo.header_offset)
+		nlen, elen = struct.unpack('<HH', header[26:30])
+		start = zinfo.header_offset + 30 + nlen + elen
+		m = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+		return cls(memoryview(m)[start:start + zinfo.file_size])
+
+
+class _Keys:
+	# Sequence view of the terms for bisect
+	def __init__(self, index):
+		self._index = index
+
+	def __len__(self):
+		return len(self._index)
+
+	def __getitem__(self, i):
+		return self._index._term(i)
+
+
+def _fileno(zf):
+	try:
+		return zf.fp.fileno()
+	except (AttributeError, OSError, ValueError):
+		return None
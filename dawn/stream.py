@@ -0,0 +1,300 @@
+import io
+import os
+import struct
+import tempfile
+import zipfile
+import zlib
+
+
+CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024
+
+_LOCAL_HEADER = struct.Struct('<4sHHHHHLLLHH')
+_LOCAL_SIG = b'PK\x03\x04'
+_DESCRIPTOR_SIG = b'PK\x07\x08'
+
+
+class StreamZipFile:
+	"""
+	Read-only zip reader working on non-seekable file objects.
+
+	Local file headers are walked sequentially. Opening an entry that is
+	further in the stream spools the entries in between (in memory up to
+	spool_size, then on disk), so that they can still be opened later. Each
+	entry can only be opened once.
+	"""
+
+	def __init__(self, fileobj, spool_size=SPOOL_SIZE):
+		# like zipfile.ZipFile, paths are opened (and closed) here
+		self._owned = isinstance(fileobj, (str, os.PathLike))
+		self._fp = io.open(fileobj, 'rb') if self._owned else fileobj
+		self._pushback = b''
+		self._spool_size = spool_size
+		self._spooled = {}
+		self._seen = set()
+		self._current = None
+		self._done = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		for zinfo, f in self._spooled.values():
+			f.close()
+		self._spooled.clear()
+		if self._owned:
+			self._fp.close()
+
+	def open(self, name, mode='r'):
+		if mode != 'r':
+			raise TypeError('StreamZipFile only supports mode r')
+		if isinstance(name, zipfile.ZipInfo):
+			name = name.filename
+
+		if name in self._spooled:
+			zinfo, f = self._spooled.pop(name)
+			f.seek(0)
+			return f
+		if name in self._seen:
+			raise KeyError('{} was already consumed from the stream'.format(name))
+
+		while True:
+			entry = self._next()
+			if entry is None:
+				raise KeyError(name)
+			if entry.zinfo.filename == name:
+				return entry
+			self._spool(entry)
+
+	def iterfiles(self):
+		while self._spooled:
+			name = next(iter(self._spooled))
+			zinfo = self._spooled[name][0]
+			with self.open(name) as f:
+				yield zinfo, f
+
+		while True:
+			entry = self._next()
+			if entry is None:
+				return
+			with entry:
+				yield entry.zinfo, entry
+
+	def _spool(self, entry):
+		f = tempfile.SpooledTemporaryFile(max_size=self._spool_size)
+		while True:
+			data = entry.read(CHUNK_SIZE)
+			if not data:
+				break
+			f.write(data)
+		self._spooled[entry.zinfo.filename] = (entry.zinfo, f)
+
+	def _next(self):
+		if self._current is not None:
+			self._current.close()
+			self._current = None
+		if self._done:
+			return None
+
+		header = self._read(_LOCAL_HEADER.size)
+		if header[:4] != _LOCAL_SIG:
+			# central directory, or end of the stream
+			self._done = True
+			return None
+		if len(header) < _LOCAL_HEADER.size:
+			raise zipfile.BadZipFile('Truncated local file header')
+
+		(
+			_, _, flags, method, time, date,
+			crc, csize, usize, nlen, elen,
+		) = _LOCAL_HEADER.unpack(header)
+		name = self._read(nlen)
+		extra = self._read(elen)
+
+		if flags & 0x01:
+			raise NotImplementedError('Encrypted entries are not supported')
+		if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+			raise NotImplementedError('Unsupported compression method {}'.format(method))
+
+		zinfo = zipfile.ZipInfo(
+			name.decode('utf-8' if flags & 0x800 else 'cp437'),
+			date_time=(
+				(date >> 9) + 1980, (date >> 5) & 0xF, date & 0x1F,
+				time >> 11, (time >> 5) & 0x3F, (time & 0x1F) * 2,
+			),
+		)
+		zinfo.flag_bits = flags
+		zinfo.compress_type = method
+		zinfo.extra = extra
+		zinfo.CRC = crc
+		zinfo.compress_size = csize
+		zinfo.file_size = usize
+
+		zip64 = _zip64_sizes(extra)
+		if zip64 is not None:
+			zinfo.file_size, zinfo.compress_size = zip64
+
+		self._seen.add(zinfo.filename)
+		self._current = _Entry(self, zinfo, zip64 is not None)
+		return self._current
+
+	def _read(self, n):
+		data = self._pushback[:n]
+		self._pushback = self._pushback[n:]
+		while len(data) < n:
+			chunk = self._fp.read(n - len(data))
+			if not chunk:
+				break
+			data += chunk
+		return data
+
+	def _unread(self, data):
+		self._pushback = data + self._pushback
+
+
+class _Entry(io.BufferedIOBase):
+	def __init__(self, zf, zinfo, zip64):
+		self.zinfo = zinfo
+		self._zf = zf
+		self._zip64 = zip64
+		self._descriptor = bool(zinfo.flag_bits & 0x08)
+		self._left = None if self._descriptor else zinfo.compress_size
+		self._decompressor = None
+		if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+			self._decompressor = zlib.decompressobj(-15)
+		self._buffer = bytearray()
+		self._raw = bytearray()
+		self._count = 0
+		self._crc = 0
+		self._eof = False
+
+	def readable(self):
+		return True
+
+	def read(self, n=-1):
+		if self.closed:
+			raise ValueError('I/O operation on closed entry')
+		if n is None:
+			n = -1
+		while not self._eof and (n < 0 or len(self._buffer) < n):
+			self._buffer += self._chunk()
+		if n < 0:
+			n = len(self._buffer)
+		data = bytes(self._buffer[:n])
+		del self._buffer[:n]
+		return data
+
+	def read1(self, n=-1):
+		return self.read(n)
+
+	def close(self):
+		if not self.closed:
+			self._skip()
+		super().close()
+
+	def _skip(self):
+		if self._decompressor is None or self._left is None:
+			while not self._eof:
+				self._chunk()
+			return
+
+		# the compressed size is known, no need to inflate what is skipped
+		while self._left:
+			raw = self._zf._read(min(CHUNK_SIZE, self._left))
+			if not raw:
+				raise zipfile.BadZipFile('Truncated entry {}'.format(self.zinfo.filename))
+			self._left -= len(raw)
+		self._eof = True
+
+	def _chunk(self):
+		if self._decompressor is None and self._descriptor:
+			return self._stored_chunk()
+
+		size = CHUNK_SIZE if self._left is None else min(CHUNK_SIZE, self._left)
+		raw = self._zf._read(size)
+		if size and not raw:
+			raise zipfile.BadZipFile('Truncated entry {}'.format(self.zinfo.filename))
+
+		if self._left is not None:
+			self._left -= len(raw)
+
+		if self._decompressor is None:
+			data = raw
+			finished = self._left == 0
+		else:
+			data = self._decompressor.decompress(raw)
+			if self._left is None:
+				finished = self._decompressor.eof
+				if finished:
+					self._zf._unread(self._decompressor.unused_data)
+			else:
+				finished = self._left == 0
+				if finished:
+					data += self._decompressor.flush()
+
+		self._crc = zlib.crc32(data, self._crc)
+		if finished:
+			self._finish()
+		return data
+
+	def _stored_chunk(self):
+		# Without a compressed size, the end of a stored entry can only be
+		# found by looking for a data descriptor matching what was read so far
+		sizes = '<QQ' if self._zip64 else '<LL'
+		size = 8 + struct.calcsize(sizes)
+
+		while True:
+			raw = self._zf._read(CHUNK_SIZE)
+			if not raw:
+				raise zipfile.BadZipFile('Truncated entry {}'.format(self.zinfo.filename))
+			self._raw += raw
+
+			idx = self._raw.find(_DESCRIPTOR_SIG)
+			while idx >= 0 and idx + size <= len(self._raw):
+				crc, = struct.unpack('<L', self._raw[idx + 4:idx + 8])
+				csize, usize = struct.unpack(sizes, self._raw[idx + 8:idx + size])
+				if csize == usize == self._count + idx and crc == zlib.crc32(self._raw[:idx], self._crc):
+					data = bytes(self._raw[:idx])
+					self._zf._unread(bytes(self._raw[idx + size:]))
+					self._raw.clear()
+					self._eof = True
+					self.zinfo.CRC = crc
+					self.zinfo.compress_size = self.zinfo.file_size = usize
+					return data
+				idx = self._raw.find(_DESCRIPTOR_SIG, idx + 1)
+
+			keep = len(self._raw) - size + 1 if idx < 0 else idx
+			if keep > 0:
+				data = bytes(self._raw[:keep])
+				del self._raw[:keep]
+				self._count += len(data)
+				self._crc = zlib.crc32(data, self._crc)
+				return data
+
+	def _finish(self):
+		self._eof = True
+		if self._descriptor:
+			sizes = '<QQ' if self._zip64 else '<LL'
+			size = 4 + struct.calcsize(sizes)
+			data = self._zf._read(4)
+			if data == _DESCRIPTOR_SIG:
+				data = self._zf._read(size)
+			else:
+				data += self._zf._read(size - 4)
+			self.zinfo.CRC, = struct.unpack('<L', data[:4])
+			self.zinfo.compress_size, self.zinfo.file_size = struct.unpack(sizes, data[4:])
+
+		if self._crc != self.zinfo.CRC:
+			raise zipfile.BadZipFile('Bad CRC-32 for file {!r}'.format(self.zinfo.filename))
+
+
+def _zip64_sizes(extra):
+	while len(extra) >= 4:
+		tp, ln = struct.unpack('<HH', extra[:4])
+		if tp == 0x0001 and ln >= 16:
+			return struct.unpack('<QQ', extra[4:20])
+		extra = extra[4 + ln:]
+	return None
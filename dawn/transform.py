@@ -0,0 +1,537 @@
+import copy
+import io
+import lxml.etree
+import multiprocessing
+import posixpath
+import re
+import urllib.parse
+import zipfile
+
+from .open import open as dawn_open
+from .positions import POSITIONS_HREF
+from .search import INDEX_HREF
+from .utils import BLOCKS
+from .utils import ns
+from .utils import NS
+
+
+SPLIT_SIZE = 256 * 1024
+
+_XHTML = 'application/xhtml+xml'
+_CSS = 'text/css'
+_SVG = 'image/svg+xml'
+_XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+_XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+_WRAPPERS = {ns('html:' + t) for t in ('div', 'section', 'article', 'main')}
+_BLOCKS = {ns('html:' + t) for t in BLOCKS}
+_PRESERVE = {ns('html:' + t) for t in ('pre', 'textarea', 'script', 'style')}
+# Already compressed media, deflating them again only costs CPU
+_STORED = ('image/', 'audio/', 'video/', 'font/woff', 'application/font-woff', 'application/zip', 'application/pdf')
+
+_CSS_TOKENS = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|/\*.*?\*/''', re.DOTALL)
+_CSS_SPACES = re.compile(r'\s*([{};,>])\s*')
+_CSS_URLS = re.compile(r'''url\(\s*(['"]?)(.*?)\1\s*\)|@import\s+(['"])(.*?)\3''')
+
+
+def split(src, dst, max_size=SPLIT_SIZE, **kwargs):
+	"""
+	Copy src to dst, splitting the XHTML spine documents bigger than max_size
+	bytes into several manifest items. Documents are cut between block
+	elements (children of the body or of div/section/article/main wrappers),
+	and the spine, the TOC and the links pointing inside them are updated.
+	"""
+	with dawn_open(src) as epub:
+		sizes = {s.iid: s for s in epub.stats()}
+		spine = {item.iid for item in epub.spine}
+		plans = {}
+		for item in epub.manifest.values():
+			stat = sizes.get(item.iid)
+			if item.iid in spine and item.mimetype == _XHTML and stat and stat.file_size > max_size:
+				try:
+					plan = _Plan(epub, item, max_size)
+				except lxml.etree.XMLSyntaxError:
+					# copied unchanged
+					continue
+				if len(plan.hrefs) > 1:
+					plans[item.href] = plan
+
+		anchors = {href: (plan.hrefs, plan.ids) for href, plan in plans.items()}
+
+		with _Copy(epub, dst, anchors, **kwargs) as out:
+			parts = {}
+			for item in out.items():
+				plan = plans.get(item.href)
+				if plan is not None:
+					parts[item.iid] = list(plan.write(epub, out.epub, anchors, sizes[item.iid].compress_type))
+				elif item.mimetype == _XHTML and anchors:
+					with epub.open(item) as f:
+						out.copy_item(item, _relink_document(f.read(), item.href, anchors))
+				else:
+					out.copy_item(item)
+			out.copy_spine(parts)
+
+
+def index(src, dst, search_index=True, positions=False, **kwargs):
+	"""
+	Copy src to dst, adding a full-text search index of the spine documents
+	(see Epub.search) and/or a position map (see Epub.positions). Existing
+	ones are replaced.
+	"""
+	with dawn_open(src) as epub:
+		with _Copy(epub, dst, {}, search_index=search_index, positions=positions, **kwargs) as out:
+			for item in out.items():
+				out.copy_item(item)
+			out.copy_spine()
+
+
+class _Copy:
+	# Opens dst for writing with the metadata and TOC of epub, the manifest
+	# items and the spine are then copied with copy_item and copy_spine. The
+	# search index and position map depend on the spine documents, they are
+	# generated again instead of being copied.
+	def __init__(self, epub, dst, anchors, **kwargs):
+		self._epub = epub
+		self._anchors = anchors
+		self._sizes = {s.iid: s for s in epub.stats()}
+		hrefs = {item.href for item in epub.manifest.values()}
+		kwargs.setdefault('search_index', INDEX_HREF in hrefs)
+		kwargs.setdefault('positions', POSITIONS_HREF in hrefs)
+		self._open = dawn_open(dst, mode='w', version=epub.version, opfpath=epub._opfpath, **kwargs)
+		self.epub = None
+
+	def __enter__(self):
+		epub = self._epub
+		out = self.epub = self._open.__enter__()
+
+		uid = out.uid
+		out.meta.update(copy.deepcopy(epub.meta))
+		if epub.uid is not None and 'id' in epub.uid:
+			out.uid = next(i for i in out.meta['identifiers'] if i.get('id') == epub.uid['id'])
+		else:
+			out.meta['identifiers'].append(uid)
+
+		def toc(src, dst):
+			for it in src:
+				child = dst.append(_relink(it.href, '', self._anchors), it.title)
+				toc(it.children, child.children)
+		out.toc.title = epub.toc.title
+		out.toc.item = epub.toc.item
+		toc(epub.toc, out.toc)
+
+		return self
+
+	def __exit__(self, *args):
+		return self._open.__exit__(*args)
+
+	def items(self):
+		for item in self._epub.manifest.values():
+			if item.href not in (INDEX_HREF, POSITIONS_HREF):
+				yield item
+
+	def copy_item(self, item, data=None, **kwargs):
+		# data defaults to the content of item, compress_type to its current one
+		if data is None:
+			with self._epub.open(item) as f:
+				data = f.read()
+		if 'compress_type' not in kwargs and item.iid in self._sizes:
+			kwargs['compress_type'] = self._sizes[item.iid].compress_type
+		return self.epub.writestr(self.epub.manifest.Item(item.iid, item.href), data, **kwargs)
+
+	def copy_spine(self, parts=None):
+		# parts maps the iids of the split items to the items replacing them
+		for item in self._epub.spine:
+			if item is self._epub.toc.item:
+				# the TOC is not in the manifest (see Epub30._read_toc)
+				self.epub.spine.append(self.epub.toc.item)
+				continue
+			for part in (parts or {}).get(item.iid, [self.epub.manifest[item.iid]]):
+				self.epub.spine.append(part)
+
+
+class _Plan:
+	# First pass over an oversized document: decide where to cut it and
+	# which part each id ends up in, without keeping the document in memory
+	def __init__(self, epub, item, max_size):
+		self.ids = {}
+		self.breaks = set()
+
+		base, ext = posixpath.splitext(item.href)
+		self.hrefs = [item.href]
+		self.iids = [item.iid]
+
+		size = 0
+		with epub.open(item) as f:
+			for i, (path, block, first) in enumerate(_Blocks(f)):
+				block_size = len(lxml.etree.tostring(block))
+				if size and size + block_size > max_size:
+					self.breaks.add(i)
+					n = len(self.hrefs)
+					self.hrefs.append(_unique('{}-{}'.format(base, n), {i.href for i in epub.manifest.values()}, ext))
+					self.iids.append(_unique('{}-{}'.format(item.iid, n), epub.manifest))
+					size = 0
+				size += block_size
+
+				for el in [w for w in path if first.get(w)] + list(block.iter()):
+					if isinstance(el.tag, str) and el.get('id') is not None:
+						self.ids.setdefault(el.get('id'), len(self.hrefs) - 1)
+
+	def write(self, epub, out, anchors, compress_type):
+		# Second pass: rebuild and write each part as soon as it is complete
+		part = None
+		with epub.open(self.hrefs[0]) as f:
+			blocks = _Blocks(f)
+			for i, (path, block, first) in enumerate(blocks):
+				if i == 0 or i in self.breaks:
+					if part is not None:
+						yield self._write(out, part, anchors, compress_type)
+					part = _Part(blocks, 0 if part is None else part.n + 1)
+				part.add(path, block, first)
+			yield self._write(out, part, anchors, compress_type)
+
+	def _write(self, out, part, anchors, compress_type):
+		part.close()
+		href = self.hrefs[part.n]
+		for el in part.root.iter():
+			if isinstance(el.tag, str) and el.get('href') is not None:
+				el.set('href', _relink(el.get('href'), self.hrefs[0], anchors, href))
+		data = lxml.etree.tostring(
+			part.root,
+			doctype=part.doctype,
+			xml_declaration=True,
+			encoding='utf-8',
+		)
+		return out.writestr(out.manifest.Item(self.iids[part.n], href), data, compress_type=compress_type)
+
+
+class _Part:
+	def __init__(self, blocks, n):
+		self.n = n
+		self.doctype = blocks.doctype
+		self._blocks = blocks
+		self.root = lxml.etree.Element(blocks.root.tag, blocks.root.attrib, nsmap=blocks.root.nsmap)
+		if blocks.head is not None:
+			self.root.append(copy.deepcopy(blocks.head))
+		self.body = lxml.etree.SubElement(self.root, blocks.body.tag, blocks.body.attrib)
+		if n == 0:
+			self.body.text = blocks.body.text
+		self._open = []
+
+	def add(self, path, block, first):
+		self.close()
+		i = 0
+		while i < len(self._open) and i < len(path) and self._open[i][0] is path[i]:
+			i += 1
+		del self._open[i:]
+
+		for w in path[i:]:
+			parent = self._open[-1][1] if self._open else self.body
+			attrib = dict(w.attrib)
+			if first.get(w):
+				el = lxml.etree.SubElement(parent, w.tag, attrib)
+				el.text = w.text
+			else:
+				attrib.pop('id', None)
+				el = lxml.etree.SubElement(parent, w.tag, attrib)
+			self._open.append((w, el))
+
+		parent = self._open[-1][1] if self._open else self.body
+		parent.append(copy.deepcopy(block))
+
+	def close(self):
+		# text following the wrappers closed since the last block
+		opened = dict(self._open)
+		while self._blocks.tails:
+			w, tail = self._blocks.tails.pop(0)
+			el = opened.get(w)
+			if el is None:
+				el = self.body[-1] if len(self.body) else None
+			if el is None:
+				self.body.text = (self.body.text or '') + tail
+			else:
+				el.tail = (el.tail or '') + tail
+
+
+class _Blocks:
+	# Iterates over (wrappers, block, first) for the blocks of an XHTML
+	# document. Each block is dropped from the tree once yielded, and first
+	# tells for each wrapper whether this is its first block. The tails of
+	# the wrappers closed in between are queued in tails.
+	def __init__(self, f):
+		self.doctype = None
+		self.root = self.head = self.body = None
+		self.tails = []
+		self._events = lxml.etree.iterparse(f, events=('start', 'end'), huge_tree=True, resolve_entities=False)
+
+	def __iter__(self):
+		path = []
+		started = set()
+		depth = 0
+
+		for event, el in self._events:
+			if event == 'start':
+				if self.root is None:
+					self.root = el
+					self.doctype = el.getroottree().docinfo.doctype
+				elif depth:
+					depth += 1
+				elif self.body is None:
+					if el.tag == ns('html:body'):
+						self.body = el
+				elif el.tag in _WRAPPERS:
+					path.append(el)
+				else:
+					depth = 1
+				continue
+
+			if depth:
+				depth -= 1
+				if depth == 0:
+					yield from self._yield(path, el, started)
+			elif el.tag == ns('html:head'):
+				self.head = el
+			elif path and el is path[-1]:
+				path.pop()
+				if el not in started:
+					# wrapper without blocks, it is a block on its own
+					yield from self._yield(path, el, started)
+				else:
+					started.discard(el)
+					if el.tail:
+						self.tails.append((el, el.tail))
+					el.getparent().remove(el)
+
+	def _yield(self, path, el, started):
+		first = {w: w not in started for w in path}
+		started.update(path)
+		yield tuple(path), el, first
+		el.getparent().remove(el)
+
+
+def _unique(name, taken, ext=''):
+	# the counter goes before ext, so that the media type is kept
+	res, n = name + ext, 0
+	while res in taken:
+		n += 1
+		res = '{}-{}{}'.format(name, n, ext)
+	return res
+
+def _relink(link, href, anchors, current=None):
+	# Rewrite link, found in the document at href (relative to the opf), to
+	# point to the part containing its target. current is where the link
+	# ends up when the document itself is being split.
+	url = urllib.parse.urlsplit(link)
+	if url.scheme or url.netloc:
+		return link
+
+	base = posixpath.dirname(href)
+	if url.path:
+		target = posixpath.normpath(posixpath.join(base, urllib.parse.unquote(url.path)))
+	else:
+		target = href
+	if target not in anchors:
+		return link
+
+	hrefs, ids = anchors[target]
+	target = hrefs[ids.get(url.fragment, 0) if url.fragment else 0]
+	if target == (current or href):
+		return '#' + url.fragment if url.fragment else link
+	res = urllib.parse.quote(posixpath.relpath(target, base or '.'))
+	return res + '#' + url.fragment if url.fragment else res
+
+def _relink_document(data, href, anchors):
+	names = {posixpath.basename(h).encode() for h in anchors}
+	if not any(name in data for name in names):
+		return data
+
+	try:
+		tree = lxml.etree.parse(io.BytesIO(data), lxml.etree.XMLParser(huge_tree=True, resolve_entities=False))
+	except lxml.etree.XMLSyntaxError:
+		return data
+	for el in tree.iter():
+		if isinstance(el.tag, str) and el.get('href') is not None:
+			el.set('href', _relink(el.get('href'), href, anchors))
+	return lxml.etree.tostring(tree, xml_declaration=True, encoding='utf-8')
+
+
+def optimize(src, dst, jobs=None, minify=True, drop_unused=True, **kwargs):
+	"""
+	Copy src to dst, minifying XHTML and CSS, dropping the manifest items
+	that are not reachable from the spine, the TOC or the cover, deflating
+	text at the highest level and storing already compressed media.
+	Items are processed by a pool of jobs processes (cpu count by default).
+
+	Returns the compressed size before and after, per media type.
+	"""
+	with dawn_open(src) as epub:
+		before = epub.stats()
+
+		tasks = []
+		for item in epub.manifest.values():
+			if item.mimetype in (_XHTML, _CSS, _SVG):
+				with epub.open(item) as f:
+					tasks.append((item.href, item.mimetype, f.read(), minify))
+
+		if jobs == 1:
+			results = list(map(_optimize_item, tasks))
+		else:
+			with multiprocessing.Pool(jobs) as pool:
+				results = pool.map(_optimize_item, tasks)
+		results = {task[0]: res for task, res in zip(tasks, results)}
+
+		keep = set(epub.manifest)
+		if drop_unused and all(refs is not None for data, refs in results.values()):
+			keep = _reachable(epub, {href: refs for href, (data, refs) in results.items()})
+
+		kwargs.setdefault('compression', zipfile.ZIP_DEFLATED)
+		kwargs.setdefault('compresslevel', 9)
+		with _Copy(epub, dst, {}, **kwargs) as out:
+			for item in out.items():
+				if item.iid not in keep:
+					continue
+				if item.mimetype and item.mimetype.startswith(_STORED) and item.mimetype != _SVG:
+					options = {'compress_type': zipfile.ZIP_STORED}
+				else:
+					options = {'compress_type': zipfile.ZIP_DEFLATED, 'compresslevel': kwargs['compresslevel']}
+				out.copy_item(item, results[item.href][0] if item.href in results else None, **options)
+			out.copy_spine()
+
+	res = {}
+	for stats, i in ((before, 0), (out.epub.stats(), 1)):
+		for mimetype, (count, file_size, compress_size) in stats.bymimetype().items():
+			res.setdefault(mimetype, [0, 0])[i] = compress_size
+	return {k: tuple(v) for k, v in res.items()}
+
+
+def _optimize_item(task):
+	# Runs in the worker processes: returns the (maybe minified) data and
+	# the hrefs it references, or None if they could not be found
+	href, mimetype, data, minify = task
+	refs = set()
+
+	if mimetype == _CSS:
+		try:
+			text = data.decode('utf-8')
+		except UnicodeDecodeError:
+			# another @charset, the ASCII urls can still be found but the
+			# stylesheet is kept as is
+			return data, set(_css_refs(data.decode('latin-1'), href))
+		refs.update(_css_refs(text, href))
+		if minify:
+			data = _minify_css(text).encode('utf-8')
+		return data, refs
+
+	try:
+		parser = lxml.etree.XMLParser(remove_comments=minify, huge_tree=True, resolve_entities=False)
+		tree = lxml.etree.parse(io.BytesIO(data), parser)
+	except lxml.etree.XMLSyntaxError:
+		return data, None
+
+	for el in tree.iter():
+		if not isinstance(el.tag, str):
+			continue
+		for attr in ('href', 'src', 'poster', 'data', _XLINK_HREF):
+			ref = _resolve(el.get(attr), href)
+			if ref is not None:
+				refs.add(ref)
+		for candidate in (el.get('srcset') or '').split(','):
+			ref = _resolve(candidate.strip().split(' ')[0], href)
+			if ref is not None:
+				refs.add(ref)
+		if el.get('style'):
+			refs.update(_css_refs(el.get('style'), href))
+		if el.tag in (ns('html:style'), '{http://www.w3.org/2000/svg}style') and el.text:
+			refs.update(_css_refs(el.text, href))
+			if minify:
+				el.text = _minify_css(el.text)
+
+	if minify and mimetype == _XHTML:
+		_strip_blanks(tree.getroot())
+	if minify:
+		data = lxml.etree.tostring(tree, xml_declaration=True, encoding='utf-8')
+	return data, refs
+
+def _strip_blanks(el):
+	# Drop the whitespace-only text between two block boundaries, where it
+	# cannot change the rendering
+	if el.tag in _PRESERVE or el.get(_XML_SPACE) == 'preserve':
+		return
+	block = el.tag in _BLOCKS
+
+	if block and el.text and not el.text.strip():
+		if not len(el) or el[0].tag in _BLOCKS:
+			el.text = None
+
+	for i, c in enumerate(el):
+		nxt = el[i + 1] if i + 1 < len(el) else None
+		if c.tail and not c.tail.strip() and c.tag in _BLOCKS:
+			if (nxt is None and block) or (nxt is not None and nxt.tag in _BLOCKS):
+				c.tail = None
+	for c in el:
+		if isinstance(c.tag, str):
+			_strip_blanks(c)
+
+def _minify_css(text):
+	res, code, pos = [], [], 0
+
+	def flush():
+		chunk = re.sub(r'\s+', ' ', ''.join(code))
+		res.append(_CSS_SPACES.sub(r'\1', chunk).replace(';}', '}'))
+		code.clear()
+
+	for m in _CSS_TOKENS.finditer(text):
+		code.append(text[pos:m.start()])
+		if m.group(1) is None:
+			# comment
+			code.append(' ')
+		else:
+			flush()
+			res.append(m.group(1))
+		pos = m.end()
+	code.append(text[pos:])
+	flush()
+
+	return ''.join(res).strip()
+
+def _css_refs(text, href):
+	for m in _CSS_URLS.finditer(text):
+		ref = _resolve(m.group(2) if m.group(2) is not None else m.group(4), href)
+		if ref is not None:
+			yield ref
+
+def _resolve(link, href):
+	# Manifest href (relative to the opf) of link, found in the document at href
+	if not link:
+		return None
+	url = urllib.parse.urlsplit(link.strip())
+	if url.scheme or url.netloc or not url.path:
+		return None
+	return posixpath.normpath(posixpath.join(posixpath.dirname(href), urllib.parse.unquote(url.path)))
+
+def _reachable(epub, refs):
+	byhref = {item.href: item for item in epub.manifest.values()}
+
+	todo = [item.href for item in epub.spine]
+	def toc(items):
+		for it in items:
+			todo.append(_resolve(it.href, '') or '')
+			toc(it.children)
+	toc(epub.toc)
+
+	# the cover is only referenced from the opf metadata
+	with epub._zf.open(epub._opfpath) as f:
+		opf = lxml.etree.parse(f)
+	cover = opf.find('./opf:metadata/opf:meta[@name="cover"]', NS)
+	if cover is not None and cover.get('content') in epub.manifest:
+		todo.append(epub.manifest[cover.get('content')].href)
+	for item in opf.iterfind('./opf:manifest/opf:item[@properties]', NS):
+		if 'cover-image' in item.get('properties').split() and item.get('href') in byhref:
+			todo.append(item.get('href'))
+
+	seen = set()
+	while todo:
+		href = todo.pop()
+		if href in seen or href not in byhref:
+			continue
+		seen.add(href)
+		todo.extend(refs.get(href, ()))
+	return {byhref[href].iid for href in seen}
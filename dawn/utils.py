@@ -1,6 +1,8 @@
+import array
 import datetime
 import lxml.etree
 import lxml.builder
+import sys
 
 
 NS = {
@@ -27,6 +29,17 @@ def getxmlattr(tag, attr):
 			qname = lxml.etree.QName(tag.tag)
 			return tag.get('{' + RNS[qname.namespace] + '}' + attr)
 
+# Local names of the HTML elements laid out as blocks (or not rendered at
+# all): whitespace around them is not significant and they delimit words
+BLOCKS = {
+	'html', 'head', 'title', 'meta', 'link', 'base', 'style', 'script', 'noscript',
+	'body', 'address', 'article', 'aside', 'blockquote', 'details', 'dialog', 'dd',
+	'div', 'dl', 'dt', 'fieldset', 'figcaption', 'figure', 'footer', 'form',
+	'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hgroup', 'hr', 'li', 'main',
+	'nav', 'ol', 'p', 'pre', 'section', 'table', 'caption', 'colgroup', 'col',
+	'thead', 'tbody', 'tfoot', 'tr', 'td', 'th', 'ul',
+}
+
 def ns(name):
 	if ':' in name:
 		ns, name = name.split(':', 1)
@@ -43,3 +56,17 @@ def parse_date(d):
 	):
 		if len(d) == l:
 			return datetime.datetime.strptime(d, p)
+
+def uint32s(values=()):
+	res = array.array('L' if array.array('L').itemsize == 4 else 'I', values)
+	assert res.itemsize == 4
+	return res
+
+def uint32_view(buf):
+	# buf holds little-endian uint32s, only copied on big-endian platforms
+	if sys.byteorder == 'little':
+		return buf.cast('B').cast(uint32s().typecode)
+	res = uint32s()
+	res.frombytes(buf)
+	res.byteswap()
+	return res
@@ -17,6 +17,9 @@ setup(
 	license='MIT',
 	packages=['dawn'],
 	install_requires=requirements,
+	entry_points={
+		'console_scripts': ['dawn = dawn.cli:main'],
+	},
 	setup_requires=[
 		'pytest-runner >= 5.1, < 6',
 	],
@@ -0,0 +1,87 @@
+import dawn
+import dawn.cli
+import json
+import os
+import pytest
+import zipfile
+
+
+@pytest.fixture
+def book(tmpdir):
+	path = str(tmpdir.join('book.epub'))
+	with dawn.open(path, mode='w', version='3.0') as epub:
+		epub.meta['titles'] = [dawn.AS('My ePub', lang='en')]
+		item = epub.writestr('text/chapter.html', '<p>Hello</p>')
+		epub.spine.append(item)
+		epub.toc.append(item.href, title='Chapter', children=[
+			('text/chapter.html#sub', 'Sub'),
+		])
+		epub.toc.append('missing.html', title='Broken')
+	return path
+
+def _run(capsys, *argv):
+	code = dawn.cli.main(list(argv))
+	return code, [json.loads(l) for l in capsys.readouterr().out.splitlines()]
+
+def test_info(capsys, book):
+	code, (res,) = _run(capsys, 'info', book)
+	assert code == 0
+	assert res['path'] == book
+	assert res['version'] == '3.0'
+	assert res['meta']['titles'] == [{'value': 'My ePub', 'lang': 'en'}]
+	assert res['spine'] == 1
+
+def test_toc(capsys, book):
+	code, (res,) = _run(capsys, 'toc', book)
+	assert res['toc'][0] == {
+		'href': 'text/chapter.html',
+		'title': 'Chapter',
+		'children': [{'href': 'text/chapter.html#sub', 'title': 'Sub'}],
+	}
+
+def test_ls(capsys, book):
+	code, (res,) = _run(capsys, 'ls', book)
+	assert res['manifest'] == [
+		{'id': 'item-0', 'href': 'text/chapter.html', 'mimetype': 'application/xhtml+xml', 'spine': True},
+	]
+
+def test_extract(capsys, book, tmpdir):
+	code, (res,) = _run(capsys, 'extract', '-o', str(tmpdir), book)
+	assert res['files'] == 1
+	with open(os.path.join(res['output'], 'text', 'chapter.html')) as f:
+		assert f.read() == '<p>Hello</p>'
+
+def test_validate(capsys, book, tmpdir):
+	missing = str(tmpdir.join('missing.epub'))
+	code, res = _run(capsys, 'validate', book, missing)
+	assert code == 1
+	assert res[0]['valid'] is False
+	assert res[0]['errors'] == ["TOC entry 'Broken' points outside the manifest (missing.html)"]
+	assert res[1]['valid'] is False
+
+def test_jobs_and_files_from(capsys, book, tmpdir):
+	lst = tmpdir.join('list.txt')
+	lst.write('\n'.join([book] * 5) + '\n')
+	code, res = _run(capsys, 'info', '-j', '2', '-f', str(lst), book)
+	assert code == 0
+	assert len(res) == 6
+	assert all(r['version'] == '3.0' for r in res)
+
+def test_error(capsys, tmpdir):
+	code, (res,) = _run(capsys, 'info', str(tmpdir.join('missing.epub')))
+	assert code == 1
+	assert res['error'].startswith('FileNotFoundError')
+
+def test_info_empty_meta(capsys, tmpdir):
+	# empty <dc:description/>, read as an AttributedString of None
+	src, path = str(tmpdir.join('src.epub')), str(tmpdir.join('empty.epub'))
+	with dawn.open(src, mode='w', version='3.0') as epub:
+		epub.meta['titles'] = [dawn.AS('My ePub', lang='en')]
+		epub.meta['description'] = dawn.AS('DESCRIPTION')
+	with zipfile.ZipFile(src) as zin, zipfile.ZipFile(path, 'w') as zout:
+		for zinfo in zin.infolist():
+			zout.writestr(zinfo, zin.read(zinfo).replace(b'DESCRIPTION', b''))
+
+	code, (res,) = _run(capsys, 'info', path)
+	assert code == 0
+	assert res['meta']['description'] == {'value': None}
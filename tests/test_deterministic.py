@@ -0,0 +1,72 @@
+import dawn
+import io
+import os
+import pytest
+import zipfile
+
+
+def _write(out, version, title='My ePub', text='Hello', **kwargs):
+	with dawn.open(out, mode='w', version=version, **kwargs) as epub:
+		epub.meta['creators'] = [dawn.AS('Me', role='author', **{'file-as': 'Me'})]
+		epub.meta['titles'] = [dawn.AS(title, lang='en')]
+		item = epub.writestr('chapter.html', '<p>{}</p>'.format(text))
+		epub.spine.append(item)
+		epub.toc.append(item.href, title='Chapter')
+	return epub
+
+@pytest.mark.parametrize('version', ['2.0', '3.0'])
+def test_deterministic(version):
+	outs = [io.BytesIO() for _ in range(2)]
+	epubs = [_write(out, version, deterministic=True) for out in outs]
+	assert outs[0].getvalue() == outs[1].getvalue()
+	assert epubs[0].uid.value == epubs[1].uid.value
+
+	other = io.BytesIO()
+	assert _write(other, version, title='Other', deterministic=True).uid.value != epubs[0].uid.value
+	assert _write(other, version, text='Volume 2', deterministic=True).uid.value != epubs[0].uid.value
+
+	with zipfile.ZipFile(outs[0]) as zf:
+		assert {i.date_time for i in zf.infolist()} == {(1980, 1, 1, 0, 0, 0)}
+		assert {i.create_system for i in zf.infolist()} == {3}
+		assert b'1980-01-01T00:00:00Z' in zf.read('content.opf')
+
+def test_not_deterministic():
+	outs = [io.BytesIO() for _ in range(2)]
+	for out in outs:
+		_write(out, '3.0')
+	assert outs[0].getvalue() != outs[1].getvalue()
+
+def test_cache(tmpdir):
+	path = str(tmpdir.join('book.epub'))
+	cache_path = str(tmpdir.join('cache.json'))
+
+	with dawn.BuildCache(cache_path) as cache:
+		_write(path, '3.0', cache=cache)
+		assert cache.updated == {path}
+	with open(path, 'rb') as f:
+		data = f.read()
+	os.utime(path, (0, 0))
+
+	with dawn.BuildCache(cache_path) as cache:
+		_write(path, '3.0', cache=cache)
+		assert cache.updated == set()
+	assert os.stat(path).st_mtime == 0
+
+	with dawn.BuildCache(cache_path) as cache:
+		_write(path, '3.0', title='Other', cache=cache)
+		assert cache.updated == {path}
+	with open(path, 'rb') as f:
+		assert f.read() != data
+
+	os.unlink(path)
+	cache = dawn.BuildCache(cache_path)
+	_write(path, '3.0', title='Other', cache=cache)
+	assert cache.updated == {path}
+
+def test_cache_requires_path():
+	with pytest.raises(TypeError):
+		dawn.open(io.BytesIO(), mode='w', version='3.0', cache=dawn.BuildCache())
+
+def test_cache_read_mode(tmpdir):
+	with pytest.raises(TypeError):
+		dawn.open(str(tmpdir.join('book.epub')), deterministic=True)
@@ -0,0 +1,105 @@
+import dawn
+import io
+import pytest
+import zipfile
+
+from dawn.stream import StreamZipFile
+
+
+class Unseekable(io.RawIOBase):
+	def __init__(self, data=b''):
+		self._data = io.BytesIO(data)
+
+	def readable(self):
+		return True
+
+	def writable(self):
+		return True
+
+	def readinto(self, b):
+		data = self._data.read(min(len(b), 1000))
+		b[:len(data)] = data
+		return len(data)
+
+	def write(self, b):
+		return self._data.write(b)
+
+	def getvalue(self):
+		return self._data.getvalue()
+
+
+def _build(out, version):
+	with dawn.open(out, mode='w', version=version) as epub:
+		epub.meta['titles'] = [dawn.AS('My ePub', lang='en')]
+		for i in range(3):
+			item = epub.writestr(
+				'chapter{}.html'.format(i),
+				'<p>{}</p>'.format(i) * 10000,
+				compress_type=zipfile.ZIP_DEFLATED,
+			)
+			epub.spine.append(item)
+			epub.toc.append(item.href, title='Chapter {}'.format(i))
+		epub.writestr('cover.png', b'PK\x07\x08' * 50000, compress_type=zipfile.ZIP_STORED)
+
+
+@pytest.fixture(params=['2.0', '3.0'])
+def version(request):
+	return request.param
+
+@pytest.fixture(params=[io.BytesIO, Unseekable], ids=['seekable', 'unseekable'])
+def data(request, version):
+	out = request.param()
+	_build(out, version)
+	return out.getvalue()
+
+def test_stream_read(data):
+	with dawn.open(io.BytesIO(data)) as ref:
+		expected = (
+			[(k, v.href) for k, v in ref.manifest.items()],
+			[v.iid for v in ref.spine],
+			[(it.href, it.title) for it in ref.toc],
+			ref.meta['titles'][0].value,
+		)
+		contents = {item.iid: f.read() for item, f in ref.iterfiles()}
+
+	with dawn.open(Unseekable(data), stream=True) as epub:
+		assert (
+			[(k, v.href) for k, v in epub.manifest.items()],
+			[v.iid for v in epub.spine],
+			[(it.href, it.title) for it in epub.toc],
+			epub.meta['titles'][0].value,
+		) == expected
+		assert {item.iid: f.read() for item, f in epub.iterfiles()} == contents
+
+def test_stream_open(data):
+	with dawn.open(Unseekable(data), stream=True) as epub:
+		with epub.open(epub.spine[1]) as f:
+			assert f.read(3) == b'<p>'
+		with epub.open(epub.spine[0]) as f:
+			assert f.read() == b'<p>0</p>' * 10000
+		with pytest.raises(KeyError):
+			epub.open(epub.spine[0])
+		with pytest.raises(KeyError):
+			epub.open('missing.html')
+
+def test_stream_bad_crc():
+	out = io.BytesIO()
+	with zipfile.ZipFile(out, 'w') as zf:
+		zf.writestr('a', b'abc')
+	data = out.getvalue().replace(b'abc', b'abd', 1)
+
+	with StreamZipFile(io.BytesIO(data)) as zf:
+		with pytest.raises(zipfile.BadZipFile):
+			zf.open('a').read()
+
+def test_stream_write_mode():
+	with pytest.raises(TypeError):
+		dawn.open(None, mode='w', version='2.0', stream=True)
+
+def test_stream_path(data, tmpdir):
+	path = str(tmpdir.join('book.epub'))
+	with open(path, 'wb') as f:
+		f.write(data)
+	with dawn.open(path, stream=True) as epub:
+		with epub.open(epub.spine[0]) as f:
+			assert f.read() == b'<p>0</p>' * 10000
@@ -0,0 +1,291 @@
+import dawn
+import io
+import lxml.etree
+import pytest
+import zipfile
+
+
+DOC = '''<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Big</title></head><body><div id="top">
+<p><a href="#h9">Last section</a></p>
+{}
+</div></body></html>'''
+
+SECTION = '<section id="s{0}"><h1 id="h{0}">Title {0}</h1>{1}</section>\n'
+
+def _html(data):
+	return lxml.etree.fromstring(data)
+
+@pytest.fixture(params=['2.0', '3.0'])
+def book(request):
+	out = io.BytesIO()
+	with dawn.open(out, mode='w', version=request.param) as epub:
+		epub.meta['titles'] = [dawn.AS('Book', lang='en')]
+		body = ''.join(SECTION.format(i, '<p>Lorem ipsum dolor sit amet.</p>' * 50) for i in range(10))
+		big = epub.writestr('text/big.html', DOC.format(body))
+		other = epub.writestr(
+			'text/other.html',
+			'<html xmlns="http://www.w3.org/1999/xhtml"><body><a href="big.html#h5">5</a></body></html>',
+		)
+		epub.writestr('style.css', 'p {}')
+		epub.spine.append(big)
+		epub.spine.append(other)
+		epub.toc.append('text/big.html', 'Big', [
+			('text/big.html#h{}'.format(i), 'Title {}'.format(i))
+			for i in range(10)
+		])
+	out.seek(0)
+	return out
+
+def test_split(book):
+	out = io.BytesIO()
+	dawn.split(book, out, max_size=4000)
+
+	with dawn.open(book) as src, dawn.open(out) as epub:
+		assert epub.version == src.version
+		assert epub.uid.value == src.uid.value
+		assert epub.meta['titles'][0].value == 'Book'
+		assert 'style.css' in {item.href for item in epub.manifest.values()}
+
+		assert epub.spine[0].href == 'text/big.html'
+		assert epub.spine[-1].href == 'text/other.html'
+		parts = epub.spine[:-1]
+		assert len(parts) > 5
+
+		sections = {}
+		paragraphs = 0
+		for n, item in enumerate(parts):
+			with epub.open(item) as f:
+				data = f.read()
+			assert len(data) < 5000
+			html = _html(data)
+			assert html.find('.//{*}title').text == 'Big'
+			for h in html.iterfind('.//{*}h1'):
+				sections[h.get('id')] = item.href
+			paragraphs += len(html.findall('.//{*}section/{*}p'))
+			assert len(html.findall('.//{*}div')) == 1
+			assert (html.find('.//{*}div').get('id') == 'top') == (n == 0)
+		assert paragraphs == 500
+		assert len(sections) == 10
+
+		toc = epub.toc[0]
+		assert toc.href == 'text/big.html'
+		assert [c.href for c in toc.children] == [
+			'{}#h{}'.format(sections['h{}'.format(i)], i)
+			for i in range(10)
+		]
+
+		with epub.open(parts[0]) as f:
+			link = _html(f.read()).find('.//{*}a').get('href')
+		assert link == '{}#h9'.format(sections['h9'].split('/')[-1])
+
+		with epub.open('text/other.html') as f:
+			link = _html(f.read()).find('.//{*}a').get('href')
+		assert link == '{}#h5'.format(sections['h5'].split('/')[-1])
+
+def test_split_small(book):
+	out = io.BytesIO()
+	dawn.split(book, out)
+	with dawn.open(out) as epub:
+		assert [item.href for item in epub.spine] == ['text/big.html', 'text/other.html']
+
+def test_split_taken_name():
+	out = io.BytesIO()
+	with dawn.open(out, mode='w', version='3.0') as epub:
+		epub.meta['titles'] = [dawn.AS('Book', lang='en')]
+		body = '<p>{0}</p><p>{0}</p>'.format('x' * 100)
+		epub.spine.append(epub.writestr('a.html', DOC.format(body)))
+		epub.writestr('a-1.html', '<html xmlns="http://www.w3.org/1999/xhtml"/>')
+
+	res = io.BytesIO()
+	dawn.split(out, res, max_size=250)
+	with dawn.open(res) as epub:
+		assert [item.href for item in epub.spine] == ['a.html', 'a-1-1.html']
+		assert epub.spine[1].mimetype == 'application/xhtml+xml'
+
+def test_split_entities():
+	doctype = '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">'
+	out = io.BytesIO()
+	with dawn.open(out, mode='w', version='2.0') as epub:
+		epub.meta['titles'] = [dawn.AS('Book', lang='en')]
+		body = '<p>{0}&nbsp;a</p><p><a href="other.html">{0}&mdash;b</a></p>'.format('x' * 100)
+		epub.spine.append(epub.writestr('a.html', DOC.replace('<!DOCTYPE html>', doctype).format(body)))
+		epub.spine.append(epub.writestr('other.html', '{}<html xmlns="http://www.w3.org/1999/xhtml"><body><p><a href="a.html#top">&nbsp;</a></p></body></html>'.format(doctype)))
+		epub.writestr('broken.html', '<html><a href="a.html">{}&nbsp;</a></html>'.format('x' * 300))
+		epub.spine.append(epub.manifest.byhref('broken.html'))
+
+	res = io.BytesIO()
+	dawn.split(out, res, max_size=250)
+	with dawn.open(res) as epub:
+		assert [item.href for item in epub.spine] == ['a.html', 'a-1.html', 'other.html', 'broken.html']
+		with epub.open('a-1.html') as f:
+			data = f.read()
+		assert b'&mdash;b' in data and b'DTD XHTML 1.1' in data
+		with epub.open('other.html') as f:
+			assert b'&nbsp;' in f.read()
+
+def test_split_wrapper_tail():
+	out = io.BytesIO()
+	with dawn.open(out, mode='w', version='3.0') as epub:
+		epub.meta['titles'] = [dawn.AS('Book', lang='en')]
+		body = '<div><p>{0}</p><p>{0}</p></div>after wrapper<p>{0}</p>'.format('x' * 100)
+		epub.spine.append(epub.writestr('text/big.html', DOC.format(body)))
+
+	res = io.BytesIO()
+	dawn.split(out, res, max_size=250)
+	with dawn.open(res) as epub:
+		assert len(epub.spine) > 1
+		text = ''
+		for item in epub.spine:
+			with epub.open(item) as f:
+				text += ''.join(_html(f.read()).find('.//{*}body').itertext())
+	assert 'after wrapper' in text
+	assert text.count('x' * 100) == 3
+
+@pytest.mark.parametrize('transform', [dawn.split, dawn.optimize, dawn.index])
+def test_nav_in_spine(transform):
+	out = io.BytesIO()
+	with dawn.open(out, mode='w', version='3.0') as epub:
+		epub.meta['titles'] = [dawn.AS('Book', lang='en')]
+		epub.toc.item = nav = epub.manifest.Item('nav', 'nav.html')
+		epub.spine.append(nav)
+		epub.spine.append(epub.writestr('text.html', '<html xmlns="http://www.w3.org/1999/xhtml"><body><p>Text</p></body></html>'))
+		epub.toc.append('text.html', 'Text')
+
+	res = io.BytesIO()
+	kwargs = {'jobs': 1} if transform is dawn.optimize else {}
+	transform(out, res, **kwargs)
+	with dawn.open(res) as epub:
+		assert [item.href for item in epub.spine] == ['nav.html', 'text.html']
+		assert epub.toc.item is epub.spine[0]
+
+
+PAGE = '''<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml">
+  <head>
+    <title>Page</title>
+    <link rel="stylesheet" href="../css/style.css"/>
+  </head>
+  <body>
+    <!-- comment -->
+    <p>Hello <b>big</b> <i>world</i></p>
+    <pre>  a
+  b  </pre>
+    <img src="../img/used.png"/>
+  </body>
+</html>
+'''
+
+@pytest.fixture
+def unoptimized():
+	out = io.BytesIO()
+	with dawn.open(out, mode='w', version='3.0') as epub:
+		epub.meta['titles'] = [dawn.AS('Book', lang='en')]
+		page = epub.writestr('text/page.html', PAGE)
+		epub.writestr('css/style.css', '/* comment */\np {\n  font-family: "My  Font";\n  src: url("../fonts/font.woff");\n}\n')
+		for href in ['fonts/font.woff', 'img/used.png', 'img/unused.png']:
+			epub.writestr(href, b'\x89' * 1000)
+		epub.spine.append(page)
+		epub.toc.append(page.href, 'Page')
+	out.seek(0)
+	return out
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_optimize(unoptimized, jobs):
+	out = io.BytesIO()
+	report = dawn.optimize(unoptimized, out, jobs=jobs)
+
+	before, after = report['application/xhtml+xml']
+	assert after < before
+	assert report['image/png'] == (2000, 1000)
+
+	with dawn.open(out) as epub:
+		assert [item.href for item in epub.manifest.values()] == [
+			'text/page.html', 'css/style.css', 'fonts/font.woff', 'img/used.png',
+		]
+		stats = {s.href: s for s in epub.stats()}
+		assert stats['text/page.html'].compress_type == zipfile.ZIP_DEFLATED
+		assert stats['img/used.png'].compress_type == zipfile.ZIP_STORED
+
+		with epub.open('text/page.html') as f:
+			html = f.read().decode('utf-8')
+		assert '<head><title>Page</title><link' in html
+		assert '<p>Hello <b>big</b> <i>world</i></p><pre>  a\n  b  </pre>' in html
+		assert 'comment' not in html
+
+		with epub.open('css/style.css') as f:
+			assert f.read() == b'p{font-family: "My  Font";src: url("../fonts/font.woff")}'
+
+def test_optimize_keep_unused(unoptimized):
+	out = io.BytesIO()
+	dawn.optimize(unoptimized, out, jobs=1, drop_unused=False)
+	with dawn.open(out) as epub:
+		assert len(epub.manifest) == 5
+
+def test_optimize_css_charset():
+	css = '@charset "iso-8859-1";\np { content: "\xe9"; background: url(bg.png) }\n'.encode('latin-1')
+	out = io.BytesIO()
+	with dawn.open(out, mode='w', version='3.0') as epub:
+		epub.meta['titles'] = [dawn.AS('Book', lang='en')]
+		page = epub.writestr('page.html', '<html xmlns="http://www.w3.org/1999/xhtml"><head><link rel="stylesheet" href="style.css"/></head><body/></html>')
+		epub.writestr('style.css', css)
+		epub.writestr('bg.png', b'\x89' * 100)
+		epub.spine.append(page)
+
+	res = io.BytesIO()
+	dawn.optimize(out, res, jobs=1)
+	with dawn.open(res) as epub:
+		assert 'bg.png' in {item.href for item in epub.manifest.values()}
+		with epub.open('style.css') as f:
+			assert f.read() == css
+
+
+def test_index(book, tmpdir):
+	path = str(tmpdir.join('indexed.epub'))
+	dawn.index(book, path)
+
+	with dawn.open(path) as epub:
+		assert epub.manifest.byhref('search-index.bin') not in epub.spine
+		res = epub.search('Title')
+		assert len(res) == 10
+		assert {item.href for item, offset in res} == {'text/big.html'}
+		assert epub.search('title') == res
+		assert epub.search('missing') == []
+		assert {item.href for item, offset in epub.search('5')} == {'text/big.html', 'text/other.html'}
+
+def test_index_positions(book):
+	out = io.BytesIO()
+	dawn.index(book, out, search_index=False, positions=True)
+
+	with dawn.open(out) as epub:
+		hrefs = {item.href for item in epub.manifest.values()}
+		assert 'positions.bin' in hrefs and 'search-index.bin' not in hrefs
+		pmap = epub.positions()
+		assert len(pmap) == 2
+		toc = pmap.toc
+		assert toc[0] == 0
+		assert toc[1:] == sorted(toc[1:])
+		assert pmap.locate(toc[-1])[0] == 0
+
+@pytest.mark.parametrize('transform', [dawn.split, dawn.optimize])
+def test_index_regenerated(book, transform):
+	indexed = io.BytesIO()
+	dawn.index(book, indexed, positions=True)
+
+	out = io.BytesIO()
+	if transform is dawn.split:
+		dawn.split(indexed, out, max_size=4000)
+	else:
+		dawn.optimize(indexed, out, jobs=1)
+
+	with dawn.open(out) as epub:
+		assert len(epub.search('Title')) == 10
+		assert [item.href for item, offset in epub.search('5')][-1] == 'text/other.html'
+		pmap = epub.positions()
+		assert len(pmap) == len(epub.spine)
+		measures = []
+		for item in epub.spine:
+			with epub.open(item) as f:
+				measures.append(dawn.positions.Measure(f.read()))
+		assert pmap.tobytes() == epub._position_map(measures).tobytes()
@@ -1,39 +1,18 @@
-import datetime
 import dawn
 import io
 import hashlib
 import os
 import pytest
-import unittest.mock
 import zipfile
 
 
-@pytest.fixture
-def reproductible():
-	orig = zipfile.ZipFile.writestr
-	def writestr(self, path, *args, **kwargs):
-		if isinstance(path, str):
-			# this makes path a zipinfo with a datetime of 1980-01-01
-			path = zipfile.ZipInfo(path)
-		return orig(self, path, *args, **kwargs)
-
-	now = datetime.datetime(2019, 7, 31)
-	with \
-		unittest.mock.patch('datetime.datetime') as dt, \
-		unittest.mock.patch('uuid.uuid4', return_value='mocked uuid'), \
-		unittest.mock.patch.object(zipfile.ZipFile, 'writestr', writestr):
-		dt.now.return_value = now
-		yield
-
-pytestmark = pytest.mark.usefixtures('reproductible')
-
 @pytest.mark.parametrize('version,expected', [
-	['2.0', 'eeed938231a3ba4c1ed154e7994919130f8e4146'],
-	['3.0', 'a3e37e04c5929e94053b73cad9d5f71b7c2ec60a'],
+	['2.0', '32462e59b8cccdc4f41940ec09d96452ffef0490'],
+	['3.0', '34b741237d5ebc08901f29b7a323c173bc909769'],
 ])
 def test_epub(version, expected):
 	out = io.BytesIO()
-	with dawn.open(out, mode='w', version=version) as epub:
+	with dawn.open(out, mode='w', version=version, deterministic=True) as epub:
 		epub.meta['creators'] = [dawn.AS('Me', role='author')]
 		epub.meta['description'] = dawn.AS('Awesome book')
 		epub.meta['titles'] = [dawn.AS('My ePub', lang='en')]
@@ -97,3 +76,190 @@ def test_toc_add_missing_title(dummy):
 def test_toc_add_wrong_type(dummy):
 	with pytest.raises(TypeError):
 		dummy.toc.append(None)
+
+def test_stats():
+	out = io.BytesIO()
+	with dawn.open(out, mode='w', version='2.0') as epub:
+		for i in range(3):
+			item = epub.writestr('{}.html'.format(i), 'a' * 2000 * (i + 1), compress_type=zipfile.ZIP_DEFLATED)
+			epub.spine.append(item)
+		epub.writestr('cover.jpg', os.urandom(2000), compress_type=zipfile.ZIP_DEFLATED)
+		epub.toc.append('0.html', 'Chapter')
+
+	with dawn.open(out) as epub:
+		stats = epub.stats()
+
+	assert [(s.href, s.spine, s.file_size) for s in stats] == [
+		('0.html', 0, 2000),
+		('1.html', 1, 4000),
+		('2.html', 2, 6000),
+		('cover.jpg', None, 2000),
+		('toc.ncx', None, stats[-1].file_size),
+	]
+	assert all(s.compress_size < s.file_size for s in stats[:3])
+	assert [s.href for s in stats.largest(2)] == ['2.html', '1.html']
+	assert [s.href for s in stats.poorly_compressed()] == ['cover.jpg']
+
+	count, file_size, compress_size = stats.bymimetype()['application/xhtml+xml']
+	assert (count, file_size) == (3, 12000)
+
+@pytest.mark.parametrize('version', ['2.0', '3.0'])
+def test_reader_layout(version):
+	out = io.BytesIO()
+	with dawn.open(out, mode='w', version=version, opfpath='OEBPS/content.opf', reader_layout=True) as epub:
+		style = epub.writestr('style.css', 'p {}')
+		items = [epub.writestr('{}.html'.format(i), '<p>{}</p>'.format(i)) for i in range(3)]
+		for item in reversed(items):
+			epub.spine.append(item)
+		epub.toc.append('0.html', 'Chapter')
+
+	toc = 'OEBPS/toc.ncx' if version == '2.0' else 'OEBPS/toc.html'
+	with zipfile.ZipFile(out) as zf:
+		assert zf.namelist() == [
+			'mimetype', 'META-INF/container.xml', 'OEBPS/content.opf', toc,
+			'OEBPS/2.html', 'OEBPS/1.html', 'OEBPS/0.html', 'OEBPS/style.css',
+		]
+		assert zf.read('OEBPS/1.html') == b'<p>1</p>'
+		assert zf.getinfo('mimetype').compress_type == zipfile.ZIP_STORED
+
+def test_reader_layout_duplicate_spine():
+	out = io.BytesIO()
+	with dawn.open(out, mode='w', version='2.0', reader_layout=True) as epub:
+		item = epub.writestr('0.html', '<p>0</p>')
+		epub.spine.append(item)
+		epub.spine.append(item)
+
+	with zipfile.ZipFile(out) as zf:
+		assert zf.namelist().count('0.html') == 1
+
+def test_reader_layout_read_mode():
+	with pytest.raises(TypeError):
+		dawn.open(None, reader_layout=True)
+
+def test_search_index():
+	out = io.BytesIO()
+	with dawn.open(out, mode='w', version='3.0', search_index=True) as epub:
+		for text in ['Hello world', 'Brave <b>new</b> World']:
+			item = epub.writestr('{}.html'.format(len(epub.spine)), '<html><body><p>{}</p></body></html>'.format(text))
+			epub.spine.append(item)
+		epub.writestr('notes.html', '<html><body>world</body></html>')
+
+	with dawn.open(out) as epub:
+		assert [(item.href, offset) for item, offset in epub.search('WORLD')] == [('0.html', 6), ('1.html', 10)]
+		assert epub.search('notes') == []
+		with pytest.raises(ValueError):
+			epub.search('hello world')
+
+def test_search_adjacent_blocks():
+	out = io.BytesIO()
+	with dawn.open(out, mode='w', version='3.0', search_index=True, positions=True) as epub:
+		item = epub.writestr('0.html', '<?xml version="1.0" encoding="utf-8"?>\n<html><body><p>para1 word</p><p>needle</p></body></html>')
+		epub.spine.append(item)
+
+	with dawn.open(out) as epub:
+		assert [offset for item, offset in epub.search('word')] == [6]
+		assert [offset for item, offset in epub.search('needle')] == [11]
+		assert epub.positions().blocks(0) == [0, 11]
+
+def test_search_entities():
+	out = io.BytesIO()
+	with dawn.open(out, mode='w', version='2.0', search_index=True, positions=True) as epub:
+		item = epub.writestr('0.html', (
+			'<?xml version="1.0" encoding="utf-8"?>\n'
+			'<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n'
+			'<html xmlns="http://www.w3.org/1999/xhtml"><body><p>Hello&nbsp;world</p><p id="b">a&mdash;b</p></body></html>'
+		))
+		epub.spine.append(item)
+		epub.toc.append('0.html#b', 'B')
+
+	with dawn.open(out) as epub:
+		assert [offset for item, offset in epub.search('hello')] == [0]
+		assert [offset for item, offset in epub.search('world')] == [6]
+		assert [offset for item, offset in epub.search('b')] == [14]
+		assert epub.positions().toc == [12]
+
+def test_search_empty_document():
+	out = io.BytesIO()
+	with dawn.open(out, mode='w', version='3.0', search_index=True, positions=True) as epub:
+		for data in ['', ' \n', '<html><body><p>Hello</p></body></html>']:
+			epub.spine.append(epub.writestr('{}.html'.format(len(epub.spine)), data))
+
+	with dawn.open(out) as epub:
+		assert [(item.href, offset) for item, offset in epub.search('hello')] == [('2.html', 0)]
+		assert epub.positions().start(2) == 0
+
+def test_search_without_index():
+	out = io.BytesIO()
+	with dawn.open(out, mode='w', version='3.0'):
+		pass
+	with dawn.open(out) as epub:
+		with pytest.raises(KeyError):
+			epub.search('word')
+
+def _positions_book(out, **kwargs):
+	with dawn.open(out, mode='w', version='3.0', **kwargs) as epub:
+		for text in [
+			'<h1 id="a">Hello</h1><p>world</p>',
+			'<p>Brave</p><p id="b">new <b>world</b></p>',
+		]:
+			item = epub.writestr('{}.html'.format(len(epub.spine)), '<html><body>{}</body></html>'.format(text))
+			epub.spine.append(item)
+		epub.toc.append('0.html', 'First')
+		epub.toc.append('1.html#b', 'Second', [('missing.html', 'Missing')])
+
+def test_positions():
+	out = io.BytesIO()
+	_positions_book(out, positions=True)
+
+	with dawn.open(out) as epub:
+		assert 'positions.bin' in {item.href for item in epub.manifest.values()}
+		pmap = epub.positions()
+		assert len(pmap) == 2
+		assert pmap.length == len('Hello\nworld\n') + len('Brave\nnew world\n')
+		assert pmap.start(1) == 12
+		assert pmap.byte_start(1) == epub.stats()[0].file_size
+		assert pmap.locate(0) == (0, 0)
+		assert pmap.locate(14) == (1, 2)
+		assert pmap.locate(1000) == (1, 15)
+		assert pmap.locate_fraction(.5) == pmap.locate(14)
+		assert pmap.blocks(1) == [12, 18]
+		start = pmap.byte_start(1)
+		assert pmap.byte_blocks(1) == [start + 12, start + 24]
+		assert pmap.block_start(20) == 18
+		assert pmap.toc == [0, 18, None]
+
+		pmap.update(0, b'<html><body><p>Hi</p></body></html>')
+		assert pmap.start(1) == 3
+		assert pmap.toc == [0, 9, None]
+		assert pmap.blocks(1) == [3, 9]
+
+		restored = dawn.positions.PositionMap.frombytes(pmap.tobytes())
+		assert restored.toc == pmap.toc
+		assert restored.blocks(1) == pmap.blocks(1)
+		assert restored.byte_blocks(1) == pmap.byte_blocks(1)
+
+def test_positions_computed():
+	with_map, without_map = io.BytesIO(), io.BytesIO()
+	_positions_book(with_map, positions=True)
+	_positions_book(without_map)
+
+	with dawn.open(with_map) as a, dawn.open(without_map) as b:
+		assert a.positions().tobytes() == b.positions().tobytes()
+
+def test_positions_nav_in_spine():
+	out = io.BytesIO()
+	with dawn.open(out, mode='w', version='3.0', search_index=True, positions=True) as epub:
+		epub.toc.item = nav = epub.manifest.Item('nav', 'nav.html')
+		epub.spine.append(nav)
+		epub.spine.append(epub.writestr('text.html', '<html><body><p>Text</p></body></html>'))
+		epub.toc.append('text.html', 'Chapter')
+
+	with dawn.open(out) as epub:
+		measures = []
+		for item in epub.spine:
+			with epub.open(item) as f:
+				measures.append(dawn.positions.Measure(f.read()))
+		pmap = epub.positions()
+		assert pmap.start(1) > 0
+		assert pmap.tobytes() == epub._position_map(measures).tobytes()
+		assert [item.href for item, offset in epub.search('chapter')] == ['nav.html']